@@ -1,4 +1,5 @@
 import sys
+from pathlib import Path
 
 from shell import RUN, Shell, Stream
 
@@ -18,6 +19,10 @@ sh.input("SoMe WeIrd DaTa")("sha256sum") | RUN
 sh.input("SoMe WeIrd DaTa") | "sha256sum" | RUN
 "SoMe WeIrd DaTa" >> sh("sha256sum") | RUN
 
+# sha256sum < example.py
+sh.input_file(__file__)("sha256sum") | RUN
+Path(__file__) >> sh("sha256sum") | RUN
+
 # DATA_HASH=$(echo "SoMe WeIrd DaTa" | sha256sum)
 # or DATA_HASH=$(sha256sum <<< "SoMe WeIrd DaTa")
 data_hash = ("SoMe WeIrd DaTa" >> sh | "sha256sum").output
@@ -67,9 +72,8 @@ for _ in range(5):
     print(f'Echoer-{sys.argv[1]} got {input()!r} at {time.time()}')
 """
 
-# do_something_that_takes_a_lot_of_time & do_other_thing
-# sh(f'{exe} -u -c "{generator}"') & f'{exe} -u -c "{generator}"'
-# parallel execution is currently not implemented
+# do_something_that_takes_a_lot_of_time & do_other_thing; wait
+sh.parallel(f'{exe} -u -c "{generator}"', f'{exe} -u -c "{generator}"')
 
 # prog1 & prog2 && fg
 # foreground / background are not implemented
@@ -111,6 +115,16 @@ with sh.pipe().inject(close_stdin=False) as (inp, out, err):
         print(f"Got: {answer}, answer: {2**i}")
         assert answer == 2**i
 
+# with a buffer size the writes are batched,
+# they are sent on flush() or when the output is read
+batched = Shell(bufsize=1 << 16)
+batched(f'{exe} -u -c "{dialog}"', stdin=Stream.PIPE)
+with batched.pipe().inject(close_stdin=False) as (inp, out, err):
+    for i in [3, 0, 1, 2]:
+        inp(f"{i}\n")
+    batched.flush()
+print(f"Batched: {batched.stdout.split()}")
+
 std_out_n_err = r"""
 import sys
 print('Err', file=sys.stderr)
@@ -11,14 +11,27 @@
 from __future__ import annotations
 
 import os
+import re
+import select
 import shlex
+import shutil
 import subprocess
 import sys
+from codecs import IncrementalDecoder, getincrementaldecoder
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack, contextmanager
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from enum import Enum
+from functools import lru_cache
+from io import DEFAULT_BUFFER_SIZE, BufferedReader
 from subprocess import Popen
-from typing import IO, Dict, Iterable, Iterator, TypeVar
+from threading import Thread
+from typing import IO, Dict, Iterable, Iterator, TypeVar, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
 
 
 class Stream(Enum):
@@ -28,6 +41,32 @@ class Stream(Enum):
     DEVNULL = subprocess.DEVNULL
 
 
+# Shared by all the processes instead of Popen opening /dev/null for each,
+# Popen does not close descriptors that it did not open
+_DEVNULL = os.open(os.devnull, os.O_RDWR)
+
+# What Popen expects for every Stream, STDOUT for stdout and STDERR for stderr
+# mean the stream is inherited, they are represented with None there
+_STDIN_VALUES: Dict[Stream | None, object] = {None: None}
+_STDIN_VALUES.update((stream, stream.value) for stream in Stream)
+_STDIN_VALUES[Stream.DEVNULL] = _DEVNULL
+_STDOUT_VALUES = {**_STDIN_VALUES, Stream.STDOUT: None}
+_STDERR_VALUES = {**_STDIN_VALUES, Stream.STDERR: None}
+
+
+# exposed by the fcntl module only since Python 3.10
+_F_SETPIPE_SZ = (
+    getattr(fcntl, "F_SETPIPE_SZ", 1031) if sys.platform == "linux" else None
+)
+
+
+# matches the default capacity of the pipes on Linux
+_FEED_CHUNK = 1 << 16
+
+# an empty pipe holds at least PIPE_BUF bytes, writing that much never blocks
+_PIPE_BUF = getattr(select, "PIPE_BUF", 512)
+
+
 T1 = TypeVar("T1")
 T2 = TypeVar("T2")
 
@@ -37,11 +76,88 @@ Process = Popen[bytes]
 
 Args = Iterable[T1]
 Kwargs = Dict[str, T2]
+StrPath = Union[str, "os.PathLike[str]"]
+
+
+_SHLEX_QUOTING = re.compile(r"[\"'\\]")
+_SHLEX_WORDS = re.compile(r"[^ \t\r\n]+")
+
+
+@lru_cache(maxsize=1024)
+def _split(command: str) -> tuple[str, ...]:
+    # shlex is a pure Python tokenizer, scripts tend to repeat the same commands
+    if _SHLEX_QUOTING.search(command) is None:
+        # without quotes and escapes shlex only splits on its whitespace
+        return tuple(_SHLEX_WORDS.findall(command))
+    return tuple(shlex.split(command))
+
+
+@lru_cache(maxsize=1024)
+def _which(name: str, path: str | None) -> str | None:
+    # Like the command hashing of shells, keyed on PATH to notice its changes.
+    # Relative results depend on the current directory and are not reused
+    if os.sep in name:
+        return None
+    executable = shutil.which(name, path=path)
+    if executable is None or not os.path.isabs(executable):
+        return None
+    return executable
+
+
+def _set_pipe_size(pipe: IO[bytes] | None, size: int) -> None:
+    if pipe is None or _F_SETPIPE_SZ is None:
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), _F_SETPIPE_SZ, size)
+    except OSError:
+        # the size is capped by /proc/sys/fs/pipe-max-size
+        # and by the per-user limit on pipe buffers, keep the default then
+        pass
+
+
+def _read_available(stream: IO[bytes], n: int) -> bytes:
+    if isinstance(stream, BufferedReader):
+        # peek() does at most one read() to fill the buffer,
+        # so reading a few bytes at a time does not cost a syscall each
+        stream.peek()
+        return stream.read1(n)
+    return stream.read(n if n >= 0 else DEFAULT_BUFFER_SIZE)
+
+
+def _read_all(
+    stdout: IO[bytes] | None, stderr: IO[bytes] | None
+) -> tuple[bytes | None, bytes | None]:
+    if stdout is None or stderr is None:
+        return (
+            None if stdout is None else stdout.read(),
+            None if stderr is None else stderr.read(),
+        )
+
+    # Drain both at the same time like communicate() does, otherwise the process
+    # can get stuck on a full stderr pipe while we wait for the end of stdout
+    errors: list[bytes] = []
+    thread = Thread(target=lambda: errors.append(stderr.read()), daemon=True)
+    thread.start()
+    output = stdout.read()
+    thread.join()
+    return output, errors[0]
+
+
+def _read_text(stream: IO[bytes], decoder: IncrementalDecoder, n: int) -> str:
+    # a character can be split between the reads,
+    # so keep reading until there's something to return or the stream ended
+    while True:
+        data = _read_available(stream, n)
+        text = decoder.decode(data, final=not data)
+        if text or not data:
+            return text
 
 
 # XXX: use dict so it's easier to set kwargs
 @dataclass
 class Params:
+    __slots__ = ("args", "stdin", "stdout", "stderr", "kwargs")
+
     args: Args
     stdin: Stream | None
     stdout: Stream
@@ -50,44 +166,51 @@ class Params:
 
 
 @dataclass
-class Executor(ExitStack):
+class Executor:
     return_code: int = field(default=0, init=False)
     encoding: str = field(init=False)
+    pipe_size: int | None = field(default=None, init=False)
+    fast_spawn: bool = field(default=True, init=False)
+    bufsize: int = field(default=-1, init=False)
     _stdin: IO[bytes] | None = field(default=None, init=False, repr=False)
     _stdout: IO[bytes] | None = field(default=None, init=False, repr=False)
     _stderr: IO[bytes] | None = field(default=None, init=False, repr=False)
+    _stdout_decoder: IncrementalDecoder = field(init=False, repr=False)
+    _stderr_decoder: IncrementalDecoder = field(init=False, repr=False)
     _processes: list[Process] = field(default_factory=list, init=False, repr=False)
-
-    def __post_init__(self) -> None:
-        super().__init__()
+    _feeder: Thread | None = field(default=None, init=False, repr=False)
 
     def reset(self) -> None:
-        if len(self._processes) != 0:
-            self.close()
+        # also empties the list of processes, keeping the same list object
+        self.close()
         self.return_code = 0
         self._stdin = None
         self._stdout = None
         self._stderr = None
-        self._processes = []
-
-    def prepare_params(self, params: Params) -> tuple[Args, Kwargs]:
-        stdin: object = None if params.stdin is None else params.stdin
-        stdout: object = None if params.stdout == Stream.STDOUT else params.stdout
-        stderr: object = None if params.stderr == Stream.STDERR else params.stderr
-
-        stdin = stdin.value if isinstance(stdin, Stream) else stdin
-        stdout = stdout.value if isinstance(stdout, Stream) else stdout
-        stderr = stderr.value if isinstance(stderr, Stream) else stderr
 
-        if "stdin" not in params.kwargs:
-            params.kwargs.update(stdin=stdin)
-        params.kwargs.update(stdout=stdout)
-        params.kwargs.update(stderr=stderr)
-        return params.args, params.kwargs
-
-    def make_popen(self, params: Params) -> Process:
-        args, kwargs = self.prepare_params(params)
-        return self.enter_context(Process(*args, **kwargs))
+    def prepare_params(
+        self, params: Params, **overrides: object
+    ) -> tuple[Args, Kwargs]:
+        # a new dict every time, so the same params can be executed again
+        kwargs: Kwargs = {"stdin": _STDIN_VALUES.get(params.stdin, params.stdin)}
+        kwargs.update(params.kwargs)
+        kwargs.update(
+            stdout=_STDOUT_VALUES.get(params.stdout, params.stdout),
+            stderr=_STDERR_VALUES.get(params.stderr, params.stderr),
+            **overrides,
+        )
+        return params.args, kwargs
+
+    def make_popen(self, params: Params, **overrides: object) -> Process:
+        args, kwargs = self.prepare_params(params, **overrides)
+        # subprocess only uses posix_spawn() instead of fork() + exec()
+        # when it does not have to close the descriptors in the child,
+        # ours are not inheritable anyway (PEP 446), including the pipe ends
+        # of the previous stages, the one we read from is dup2'ed onto stdin
+        if self.fast_spawn and os.name == "posix":
+            kwargs.setdefault("close_fds", False)
+        kwargs.setdefault("bufsize", self.bufsize)
+        return Process(*args, **kwargs)
 
     def execute(
         self,
@@ -95,6 +218,10 @@ class Executor(ExitStack):
         input: str | None = None,
         close_stdin: bool = True,
         encoding: str = "utf-8",
+        pipe_size: int | None = None,
+        fast_spawn: bool = True,
+        bufsize: int = -1,
+        stdin: IO[bytes] | None = None,
     ) -> Executor:
         if len(params_list) == 0:
             raise ValueError(
@@ -103,36 +230,104 @@ class Executor(ExitStack):
         self.reset()
 
         self.encoding = encoding
+        make_decoder = getincrementaldecoder(encoding)
+        self._stdout_decoder = make_decoder()
+        self._stderr_decoder = make_decoder()
+        self.pipe_size = pipe_size
+        self.fast_spawn = fast_spawn
+        self.bufsize = bufsize
 
         params = params_list[0]
         if input is not None and params.stdin != Stream.PIPE:
             raise ValueError("To have an input the first stdin should be Stream.PIPE")
-        self._processes.append(self.make_popen(params))
 
-        for params in params_list[1:]:
-            if params.stdin == Stream.STDOUT:
-                params.kwargs["stdin"] = self._processes[-1].stdout
-            elif params.stdin == Stream.STDERR:
-                params.kwargs["stdin"] = self._processes[-1].stderr
-            elif params.stdin == Stream.DEVNULL:
-                params.kwargs["stdin"] = params.stdin.value
-            else:
-                raise ValueError(
-                    f"Invalid stdin for piped operation[{params.args}]: {params.stdin}"
-                )
-            self._processes.append(self.make_popen(params))
+        try:
+            self._spawn(params_list, stdin)
+        except:  # noqa # Don't leave the already started processes behind.
+            for process in self._processes:
+                process.kill()
+            self.close()
+            raise
 
         self._stdin = self._processes[0].stdin
         self._stdout = self._processes[-1].stdout
         self._stderr = self._processes[-1].stderr
 
-        self.write(input)
+        if input:
+            data = input.encode(encoding)
+            if self.pipe_size is not None and len(data) > _FEED_CHUNK:
+                # only an input that does not fit the default pipe gains from it
+                _set_pipe_size(self._stdin, self.pipe_size)
+            if close_stdin and len(data) > _PIPE_BUF:
+                # Write in the background so the output can be read meanwhile,
+                # like communicate() does, or both sides block on full pipes
+                self._feeder = Thread(target=self._feed, args=(data, True))
+                self._feeder.daemon = True
+                self._feeder.start()
+                close_stdin = False  # the feeder closes it once it's done
+            else:
+                self._feed(data)
         if close_stdin and self._stdin:
             self._stdin.close()
         return self
 
     __call__ = execute
 
+    def _spawn(
+        self, params_list: list[Params], first_stdin: IO[bytes] | None
+    ) -> None:
+        stages = iter(params_list)
+        # the given stdin takes the place of the first stage's one
+        overrides = {} if first_stdin is None else {"stdin": first_stdin}
+        self._processes.append(self.make_popen(next(stages), **overrides))
+
+        for params in stages:
+            upstream: IO[bytes] | None = None
+            if params.stdin == Stream.STDOUT:
+                upstream = self._processes[-1].stdout
+            elif params.stdin == Stream.STDERR:
+                upstream = self._processes[-1].stderr
+            elif params.stdin != Stream.DEVNULL:
+                raise ValueError(
+                    f"Invalid stdin for piped operation[{params.args}]: {params.stdin}"
+                )
+            if upstream is not None and self.pipe_size is not None:
+                # Only the pipes between the commands, the big ones count
+                # against the per-user limit of pipe buffers while alive
+                _set_pipe_size(upstream, self.pipe_size)
+            if params.stdin == Stream.DEVNULL:
+                stdin: object = _DEVNULL
+            else:
+                # None when the previous stage's stream was not piped,
+                # then the stdin is inherited
+                stdin = upstream
+            self._processes.append(self.make_popen(params, stdin=stdin))
+
+            # The pipe is owned by the new process now, without our copy
+            # the upstream process gets SIGPIPE if the new one exits early
+            if upstream is not None:
+                upstream.close()
+
+    def _feed(self, data: bytes, close: bool = False) -> None:
+        if not self._stdin:
+            raise ValueError("stdin is not set")
+
+        fd = self._stdin.fileno()
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(fd, view[:_FEED_CHUNK]) :]
+        except BrokenPipeError:
+            # the process does not need the rest of the input, like `head`
+            pass
+        if close:
+            self._stdin.close()
+
+    def _join_feeder(self) -> None:
+        if self._feeder is not None:
+            self._feeder.join()
+            self._feeder = None
+
     def write(self, input: str | None) -> None:
         if not input:
             return
@@ -140,56 +335,96 @@ class Executor(ExitStack):
         if not self._stdin:
             raise ValueError("stdin is not set")
 
-        os.write(self._stdin.fileno(), input.encode(self.encoding))
+        self._stdin.write(input.encode(self.encoding))
+        # the writes are batched only with an explicitly given buffer size,
+        # otherwise the command gets them right away, like when unbuffered
+        if self.bufsize <= 1:
+            self._stdin.flush()
+
+    def flush(self) -> None:
+        if not self._stdin:
+            raise ValueError("stdin is not set")
+
+        # nothing is left to send once stdin was closed
+        if not self._stdin.closed:
+            self._stdin.flush()
+
+    def _flush_stdin(self) -> None:
+        # The command can be waiting for the input that is still in our buffer,
+        # while we wait for its output. The feeder writes stdin unbuffered
+        if self._feeder is not None or not self._stdin or self._stdin.closed:
+            return
+        try:
+            self._stdin.flush()
+        except BrokenPipeError:
+            # the process exited, there's no one to read the rest
+            pass
 
-    def read_stdout(self, n: int = 2**32) -> str:
+    def read_stdout(self, n: int = -1) -> str:
         if not self._stdout:
             raise ValueError("stdout is not set")
 
-        return os.read(self._stdout.fileno(), n).decode(self.encoding)
+        self._flush_stdin()
+        return _read_text(self._stdout, self._stdout_decoder, n)
 
-    def read_stderr(self, n: int = 2**32) -> str:
+    def read_stderr(self, n: int = -1) -> str:
         if not self._stderr:
             raise ValueError("stderr is not set")
 
-        return os.read(self._stderr.fileno(), n).decode(self.encoding)
+        self._flush_stdin()
+        return _read_text(self._stderr, self._stderr_decoder, n)
 
     def get_output(self) -> tuple[str | None, str | None]:
-        out = self._stdout.read().decode(self.encoding) if self._stdout else None
-        err = self._stderr.read().decode(self.encoding) if self._stderr else None
+        self._flush_stdin()
+        out_data, err_data = _read_all(self._stdout, self._stderr)
+        out = err = None
+        if out_data is not None:
+            out = self._stdout_decoder.decode(out_data, final=True)
+        if err_data is not None:
+            err = self._stderr_decoder.decode(err_data, final=True)
 
         # XXX: should this condition be here?
         # should executor also try to imitate shell and not just wrap subprocess?
-        if out and out.endswith("\n"):
-            out = out[:-1]
+        if out is not None:
+            out = out.removesuffix("\n")
 
         return out, err
 
-    def __enter__(self):
-        return super().__enter__()
+    def __enter__(self) -> Executor:
+        return self
 
-    def __exit__(self, *exc_details):
+    def __exit__(self, *exc_details) -> None:
         try:
-            if self._stdin:
-                self._stdin.close()
             if self._stdout:
                 self._stdout.close()
             elif self._stderr:
                 self._stderr.close()
+            # the feeder is done once the process exits or reads everything
+            self._join_feeder()
+            if self._stdin:
+                try:
+                    self._stdin.close()
+                except BrokenPipeError:
+                    # the buffered input was not needed, like in communicate()
+                    pass
             self._processes[-1].wait()
         except:  # noqa # Including KeyboardInterrupt, communicate handled that.
             for process in self._processes:
                 process.kill()
-                # We don't call process.wait() as super().__exit__ does that for us.
+                # We don't call process.wait() as close() does that for us.
+            self.close()
             raise
 
         self.return_code = self._processes[-1].poll() or 0
-
-        self._processes.clear()
-        return super().__exit__(*exc_details)
+        self.close()
 
     def close(self) -> None:
-        super().close()
+        # the feeder writes to the stdin that is about to be closed
+        self._join_feeder()
+        # Popen.__exit__ closes the pipes and waits for the process,
+        # the latest processes go first like they would with an ExitStack
+        while self._processes:
+            self._processes.pop().__exit__(None, None, None)
 
 
 RUN = object()
@@ -204,31 +439,67 @@ class Shell:
     Author: 0dminnimda
     """
 
+    # capacity requested for the pipes between the commands (Linux only),
+    # bigger pipes let fast producers run further ahead of the consumers
+    pipe_size: int | None = 1 << 20
+    # spawn the commands with posix_spawn() where possible, which skips copying
+    # the page tables of this process, but also does not close descriptors
+    # that were explicitly made inheritable (os.set_inheritable) in the commands
+    fast_spawn: bool = True
+    # buffering of our ends of the pipes, as in open(): -1 is the default size,
+    # a size bigger than 1 also batches the writes of inject() until flush()
+    bufsize: int = -1
+    # the first command reads the stdin of this process like in bash,
+    # turn it off for daemons and CI, where the commands must not wait for it
+    inherit_stdin: bool = True
+
     _return_code: int = field(default=0, init=False)
     _stdout: str | None = field(default=None, init=False)
     _stderr: str | None = field(default=None, init=False)
     _executor: Executor = field(default_factory=Executor, init=False, repr=False)
     _input: str | None = field(default=None, init=False, repr=False)
+    _input_file: StrPath | None = field(default=None, init=False, repr=False)
     _args: list[Params] = field(default_factory=list, init=False, repr=False)
 
     def __repr__(self) -> str:
+        # shows the last results, logging a shell should not run the commands
         names = ["return_code", "stdout", "stderr"]
-        items = [f"{name}={getattr(self, name)!r}" for name in names]
+        items = [f"{name}={getattr(self, '_' + name)!r}" for name in names]
         return f"{type(self).__name__}({', '.join(items)})"
 
+    def status(self, discard_output: bool = False) -> Shell:
+        """Runs the pending commands, so that repr() shows their results.
+
+        `discard_output` sends the output of the last command to /dev/null
+        when only the return code is needed, it can't be read afterwards.
+        """
+
+        self._run_pending(discard_output)
+        return self
+
+    def _run_pending(self, discard_output: bool = False) -> None:
+        if not self._args:
+            return
+        if discard_output and self._args[-1].stdout == Stream.STDOUT:
+            # nobody is going to read it, so let the kernel drop the output
+            self._args[-1].stdout = Stream.DEVNULL
+            self.run()
+        else:
+            self.pipe().run()
+
     @property
     def return_code(self):
-        self.pipe(fail=False).run()
+        self._run_pending()
         return self._return_code
 
     @property
     def stdout(self):
-        self.pipe(fail=False).run()
+        self._run_pending()
         return self._stdout
 
     @property
     def stderr(self):
-        self.pipe(fail=False).run()
+        self._run_pending()
         return self._stderr
 
     @property
@@ -255,8 +526,23 @@ class Shell:
     def _execute(self, close_stdin: bool = True) -> Executor:
         if self._input:
             self._args[0].stdin = Stream.PIPE
-        self._executor.execute(self._args, self._input, close_stdin, encoding="utf-8")
+        with ExitStack() as stack:
+            file: IO[bytes] | None = None
+            if self._input_file is not None:
+                # the process reads the file by itself, like with `cmd < file`
+                file = stack.enter_context(open(self._input_file, "rb"))
+            self._executor.execute(
+                self._args,
+                self._input,
+                close_stdin,
+                encoding="utf-8",
+                pipe_size=self.pipe_size,
+                fast_spawn=self.fast_spawn,
+                bufsize=self.bufsize,
+                stdin=file,
+            )
         self._input = None
+        self._input_file = None
         return self._executor
 
     def run(self) -> Shell:
@@ -269,6 +555,13 @@ class Shell:
 
     @contextmanager
     def inject(self, close_stdin: bool = True):  # -> Iterator[tuple[]]:
+        """Runs the piped commands and yields (write, read_stdout, read_stderr).
+
+        The written data is sent to the command right away, unless `bufsize`
+        is bigger than 1, then the writes are batched until the output is read
+        or `flush()` is called.
+        """
+
         if not self._args:
             raise RuntimeError(
                 "No commands found, pipe some commands and don't use run()"
@@ -283,6 +576,30 @@ class Shell:
             self._stdout, self._stderr = self._executor.get_output()
         self._return_code = self._executor.return_code
 
+    def parallel(self, *commands: str) -> list[Shell]:
+        """Runs the commands at the same time and waits for all of them.
+
+        Every command gets its own shell with the settings of this one,
+        they are returned in the order of the commands.
+        """
+
+        def run(command: str) -> Shell:
+            return replace(self)(command).run()
+
+        # the threads only wait for the processes, so they don't need the GIL
+        with ThreadPoolExecutor(max_workers=max(len(commands), 1)) as pool:
+            return list(pool.map(run, commands))
+
+    def flush(self) -> Shell:
+        """Sends the data written in inject() to the command right away.
+
+        Only needed with a `bufsize` bigger than 1, the writes are batched then,
+        reading the output flushes them as well.
+        """
+
+        self._executor.flush()
+        return self
+
     def __call__(
         self,
         command: str,
@@ -296,7 +613,8 @@ class Shell:
 
         `stdin` controls where the process will read the data from.
         `stdin` will be initialized (`default=None`) to `Stream.STDOUT`
-        if the command list is not empty.
+        if the command list is not empty, otherwise to `Stream.DEVNULL`
+        if `inherit_stdin` is turned off.
         """
 
         # subprocess does not support changing writing target for other created stream
@@ -316,14 +634,24 @@ class Shell:
                 " for the first piping command,"
                 " actual stdout and stderr are not readable"
             )
+        elif stdin is None and not self.inherit_stdin:
+            stdin = Stream.DEVNULL
+
+        argv = list(_split(command))
+        kwargs: Kwargs = dict()
+        # the resolved path also lets subprocess use posix_spawn()
+        if os.name == "posix" and argv:
+            executable = _which(argv[0], os.environ.get("PATH"))
+            if executable is not None:
+                kwargs.update(executable=executable)
 
         self._args.append(
             Params(
-                args=tuple([shlex.split(command)]),
+                args=tuple([argv]),
                 stdin=stdin,
                 stdout=stdout,
                 stderr=stderr,
-                kwargs=dict(),
+                kwargs=kwargs,
             )
         )
 
@@ -355,9 +683,21 @@ class Shell:
                 "It's not possible to input the data in the middle of the pipe"
             )
         self._input = data
+        self._input_file = None
+        return self
+
+    def input_file(self, path: StrPath, can_override: bool = False) -> Shell:
+        if not can_override and self._args:
+            raise RuntimeError(
+                "It's not possible to input the file in the middle of the pipe"
+            )
+        self._input_file = path
+        self._input = None
         return self
 
     def __rrshift__(self, other) -> Shell:
         if isinstance(other, str):
             return self.input(other, can_override=True)
+        if isinstance(other, os.PathLike):
+            return self.input_file(other, can_override=True)
         return NotImplemented